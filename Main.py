@@ -1,13 +1,27 @@
 import streamlit as st
 import os
+import asyncio
+import aiohttp
 import requests
 import pandas as pd
 import io
+import shutil
+import tempfile
 import zipfile
-import re
 from datetime import datetime
 import dotenv
 
+EXPECTED_COLUMNS = ["invoice id", "invoice #", "supplier", "created date"]
+
+MAX_CONCURRENT_DOWNLOADS = 16
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF_SECONDS = 0.3
+COPY_CHUNK_BYTES = 65536
+# Per-PDF spool threshold before a download spills to disk.
+PDF_SPOOL_BYTES = 8 * 1024 * 1024
+
 # --- LOAD ENV VARIABLES ---
 dotenv()
 
@@ -58,18 +72,116 @@ st.markdown("""
 # --- HELPER FUNCTIONS ---
 
 
+# Built once; str.translate is a single C-level pass, cheaper than running
+# re.sub on every filename component in the download loop.
+_SANITIZE_TABLE = str.maketrans({c: "_" for c in '\\/*?:"<>|'})
+
+
 def sanitize_filename(name):
     """Remove or replace characters not allowed in filenames."""
-    return re.sub(r'[\\/*?:"<>|]', "_", str(name)).strip()
+    return str(name).translate(_SANITIZE_TABLE).strip()
 
 
-def get_local_zipinfo(filename):
-    """Return a ZipInfo object with current timestamp."""
+def get_local_zipinfo(filename, date_time=None):
+    """Return a ZipInfo object stamped with date_time (defaults to now)."""
     zinfo = zipfile.ZipInfo(filename)
-    zinfo.date_time = datetime.now().timetuple()[:6]
+    zinfo.date_time = date_time or datetime.now().timetuple()[:6]
     return zinfo
 
 
+@st.cache_data(show_spinner=False)
+def parse_invoice_csv(file_bytes):
+    """Parse the uploaded CSV, cached on the raw bytes so reruns skip re-parsing."""
+    # Sniff the delimiter from a small raw-bytes prefix; no need to decode
+    # anything, the pandas C engine decodes internally during its parse pass.
+    delimiter = "\t" if b"\t" in file_bytes[:8192] else ","
+
+    # Cheap header-only probe, then stream the file in large chunks keeping
+    # only the columns the app actually uses.
+    header = pd.read_csv(io.BytesIO(file_bytes), sep=delimiter,
+                         engine="c", encoding="utf-8", nrows=0)
+    resolved_cols = [c for c in header.columns
+                     if c.strip().lower() in EXPECTED_COLUMNS]
+    chunks = pd.read_csv(io.BytesIO(file_bytes), sep=delimiter, engine="c",
+                         encoding="utf-8", dtype=str,
+                         usecols=resolved_cols or None, chunksize=262144)
+    return pd.concat(chunks, copy=False)
+
+
+@st.cache_resource(ttl=3000, show_spinner=False)
+def get_coupa_token(identifier, secret, instance):
+    """Fetch an OAuth token once per process; shared across reruns and sessions."""
+    token_url = f"https://{instance}.coupahost.com/oauth2/token"
+    token_data = {
+        "grant_type": "client_credentials",
+        "scope": "core.invoice.read"
+    }
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    response = requests.post(token_url, auth=(identifier, secret),
+                             data=token_data, headers=headers)
+    return response.json().get("access_token")
+
+
+async def fetch_one(session, sem, invoice_id, row, column_mapping, result_cb):
+    """Fetch one invoice scan and pass (invoice_id, filename, file_or_none, status, text) to result_cb."""
+    invoice_num = sanitize_filename(row[column_mapping["invoice #"]])
+    supplier_name = sanitize_filename(row[column_mapping["supplier"]])
+    created_date_raw = str(row[column_mapping["created date"]])
+    created_date = sanitize_filename(
+        created_date_raw.split("T")[0]
+        if "T" in created_date_raw else created_date_raw
+    )
+
+    filename = f"{supplier_name} - {invoice_num} - {created_date}.pdf"
+    scan_url = f"https://{COUPA_INSTANCE}.coupahost.com/api/invoices/{invoice_id}/retrieve_image_scan"
+
+    async with sem:
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                async with session.get(scan_url) as resp:
+                    if resp.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                        await asyncio.sleep(
+                            RETRY_BACKOFF_SECONDS * (2 ** attempt))
+                        continue
+                    if resp.status == 200:
+                        # Stream the body into a spooled file so a large PDF
+                        # is never fully materialized as one bytes object.
+                        payload = tempfile.SpooledTemporaryFile(
+                            max_size=PDF_SPOOL_BYTES, mode="w+b")
+                        async for chunk in resp.content.iter_chunked(
+                                COPY_CHUNK_BYTES):
+                            payload.write(chunk)
+                        payload.seek(0)
+                        result = (invoice_id, filename,
+                                  payload, resp.status, None)
+                    else:
+                        text = await resp.text()
+                        result = (invoice_id, filename,
+                                  None, resp.status, text)
+                    break
+        except Exception as e:
+            result = (invoice_id, filename, None, None, str(e))
+
+    # The event loop runs in the main thread, so handing the payload to the
+    # (synchronous) writer here is safe; the writer closes the spooled file
+    # once it has been copied into the archive.
+    result_cb(result, row)
+
+
+async def fetch_all(invoice_ids, rows, column_mapping, headers, result_cb):
+    """Download all invoice scans concurrently against one pooled session."""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_DOWNLOADS, limit_per_host=MAX_CONCURRENT_DOWNLOADS)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(headers=headers, connector=connector,
+                                     timeout=timeout) as session:
+        async with asyncio.TaskGroup() as tg:
+            for invoice_id, row in zip(invoice_ids, rows):
+                tg.create_task(fetch_one(
+                    session, sem, invoice_id, row, column_mapping, result_cb))
+
+
 # --- PAGE HEADER ---
 st.markdown('<p class="top-right">Powered by Farried Joemratie</p>',
             unsafe_allow_html=True)
@@ -78,31 +190,20 @@ st.write("Upload your invoice CSV and download invoice PDFs in bulk from Coupa."
 
 
 # --- SESSION STATE INIT ---
-if "zip_buffer" not in st.session_state:
-    st.session_state.zip_buffer = None
 if "downloaded" not in st.session_state:
     st.session_state.downloaded = False
-if "token" not in st.session_state:
-    st.session_state.token = None
 
 
 # --- AUTO-CONNECT TO COUPA ---
-if not st.session_state.token:
-
-        if not IDENTIFIER or not SECRET or not COUPA_INSTANCE:
-            st.error()
-        else:
-            token_url = f"https://{COUPA_INSTANCE}.coupahost.com/oauth2/token"
-            token_data = {
-                "grant_type": "client_credentials",
-                "scope": "core.invoice.read"
-            }
-            headers = {"Content-Type": "application/x-www-form-urlencoded"}
-            response = requests.post(token_url, auth=(IDENTIFIER, SECRET),
-                                     data=token_data, headers=headers)
-            token = response.json().get("access_token")
-            if token:
-                st.session_state.token = token
+token = None
+if not IDENTIFIER or not SECRET or not COUPA_INSTANCE:
+    st.error()
+else:
+    token = get_coupa_token(IDENTIFIER, SECRET, COUPA_INSTANCE)
+    if not token:
+        # Never leave a failed auth in the cache for the TTL; the next
+        # rerun should retry the token endpoint.
+        get_coupa_token.clear()
 
 
 
@@ -116,124 +217,154 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file:
     try:
-        raw_csv = uploaded_file.getvalue().decode("utf-8")
-        delimiter = "\t" if "\t" in raw_csv else ","
-        df = pd.read_csv(io.StringIO(raw_csv), delimiter=delimiter)
+        df = parse_invoice_csv(uploaded_file.getvalue())
 
-        expected = ["invoice id", "invoice #", "supplier", "created date"]
-        column_mapping = {}
-        for key in expected:
-            match = [col for col in df.columns if col.strip().lower() == key]
-            if match:
-                column_mapping[key] = match[0]
+        norm = {col.strip().lower(): col for col in df.columns}
+        column_mapping = {key: norm[key]
+                          for key in EXPECTED_COLUMNS if key in norm}
 
         st.success("✅ CSV uploaded and parsed successfully!")
         st.dataframe(df.head())
 
-        if "invoice id" not in column_mapping:
-            st.warning("⚠️ 'Invoice ID' column not found — cannot fetch PDFs.")
+        missing_cols = [key for key in EXPECTED_COLUMNS
+                        if key not in column_mapping]
+        if missing_cols:
+            st.warning(
+                f"⚠️ Column(s) not found: {', '.join(missing_cols)} "
+                "— cannot fetch PDFs.")
         else:
-            invoice_ids = df[column_mapping["invoice id"]].astype(
-                str).unique().tolist()
+            # Normalize the id column once; every later lookup and the URL
+            # use these cleaned ids verbatim.
+            ids_series = df[column_mapping["invoice id"]].astype(
+                str).str.strip().str.split(".", n=1).str[0]
+            invoice_ids = ids_series.drop_duplicates().tolist()
+
+            # Build the id -> metadata lookup once instead of scanning the
+            # whole DataFrame for every invoice inside the download loop.
+            df["_iid"] = ids_series
+            meta = (
+                df.drop_duplicates(subset="_iid")
+                .set_index("_iid")[[
+                    column_mapping["invoice #"],
+                    column_mapping["supplier"],
+                    column_mapping["created date"],
+                ]]
+                .to_dict("index")
+            )
 
             if st.button("⬇️ Download All Invoice PDFs as ZIP"):
-                if not st.session_state.token:
+                if not token:
                     st.error("❌ Please connect to Coupa first.")
                 else:
                     with st.spinner("📦 Downloading invoices..."):
-                        zip_buffer = io.BytesIO()
+                        # Spill to disk past 64 MiB; writing large archives to
+                        # a temp file is much faster than growing a BytesIO.
+                        zip_buffer = tempfile.SpooledTemporaryFile(
+                            max_size=64 * 1024 * 1024, mode="w+b")
+                        # Coalesce zipfile's many small header/data writes
+                        # into 64 KiB flushes to the spooled file.
+                        zip_sink = io.BufferedWriter(
+                            zip_buffer, buffer_size=65536)
                         failed_rows = []
                         headers = {
-                            "Authorization": f"Bearer {st.session_state.token}",
+                            "Authorization": f"Bearer {token}",
                             "Accept": "application/json, */*"
                         }
 
-                        with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-                            progress = st.progress(0)
-                            status = st.empty()
-
-                            for i, invoice_id in enumerate(invoice_ids):
-                                invoice_id = str(
-                                    invoice_id).strip().split(".")[0]
-
-                                row = df[df[column_mapping["invoice id"]].astype(
-                                    str) == invoice_id].iloc[0]
-
-                                invoice_num = sanitize_filename(
-                                    row[column_mapping["invoice #"]])
-                                supplier_name = sanitize_filename(
-                                    row[column_mapping["supplier"]])
-                                created_date_raw = str(
-                                    row[column_mapping["created date"]])
-                                created_date = sanitize_filename(
-                                    created_date_raw.split("T")[0]
-                                    if "T" in created_date_raw else created_date_raw
-                                )
-
-                                filename = f"{supplier_name} - {invoice_num} - {created_date}.pdf"
-                                scan_url = f"https://{COUPA_INSTANCE}.coupahost.com/api/invoices/{invoice_id}/retrieve_image_scan"
-
-                                try:
-                                    resp = requests.get(
-                                        scan_url, headers=headers)
-
-                                    if resp.status_code == 200:
-                                        zip_file.writestr(
-                                            get_local_zipinfo(filename), resp.content)
-                                        status.success(
-                                            f"✅ Downloaded {invoice_id}")
-                                    else:
+                        rows = [meta[invoice_id]
+                                for invoice_id in invoice_ids]
+
+                        progress = st.progress(0)
+                        status = st.empty()
+                        done_count = [0]
+                        token_rejected = [False]
+                        # Redraw the bar at most ~100 times however many
+                        # invoices there are.
+                        progress_step = max(1, len(invoice_ids) // 100)
+                        # One timestamp for the whole batch; no per-file
+                        # datetime.now() conversion.
+                        batch_time = datetime.now().timetuple()[:6]
+
+                        # PDFs are already compressed; ZIP_STORED skips the
+                        # pointless deflate pass.
+                        with zipfile.ZipFile(zip_sink, "w",
+                                             compression=zipfile.ZIP_STORED) as zip_file:
+
+                            def handle_result(result, row):
+                                """Write one finished download to the ZIP and discard its bytes."""
+                                invoice_id, filename, payload, resp_status, resp_text = result
+                                done_count[0] += 1
+                                if (done_count[0] % progress_step == 0
+                                        or done_count[0] == len(invoice_ids)):
+                                    progress.progress(
+                                        done_count[0] / len(invoice_ids))
+
+                                if payload is not None:
+                                    zinfo = get_local_zipinfo(
+                                        filename, batch_time)
+                                    with zip_file.open(zinfo, "w",
+                                                       force_zip64=True) as dst:
+                                        shutil.copyfileobj(
+                                            payload, dst, COPY_CHUNK_BYTES)
+                                    payload.close()
+                                    status.success(
+                                        f"✅ Downloaded {invoice_id}")
+                                else:
+                                    failed_row = {"Invoice ID": invoice_id}
+                                    failed_row.update(row)
+                                    if resp_status is not None:
+                                        if resp_status == 401:
+                                            token_rejected[0] = True
                                         status.warning(
-                                            f"⚠️ Failed {invoice_id} ({resp.status_code})")
-
-                                        # ✅ Add a unique key for each response text area
-                                        st.text_area(
-                                            f"Response content for {invoice_id}",
-                                            resp.text,
-                                            height=120,
-                                            key=f"response_{invoice_id}"
-                                        )
-
-                                        failed_row = row.to_dict()
-                                        failed_row["Download Status"] = f"Failed ({resp.status_code})"
-                                        failed_rows.append(failed_row)
-
-                                except Exception as e:
-                                    st.error(
-                                        f"❌ Error fetching invoice {invoice_id}: {e}")
-
-                                progress.progress((i + 1) / len(invoice_ids))
-
+                                            f"⚠️ Failed {invoice_id} ({resp_status})")
+                                        failed_row["Download Status"] = f"Failed ({resp_status})"
+                                    else:
+                                        status.error(
+                                            f"❌ Error fetching invoice {invoice_id}: {resp_text}")
+                                        failed_row["Download Status"] = "Error"
+                                    failed_row["Response"] = (
+                                        resp_text or "")[:500]
+                                    failed_rows.append(failed_row)
+
+                            asyncio.run(fetch_all(
+                                invoice_ids, rows, column_mapping, headers,
+                                handle_result))
+
+                        # Drop the cached token if Coupa rejected it so the
+                        # next rerun fetches a fresh one.
+                        if token_rejected[0]:
+                            get_coupa_token.clear()
+
+                        zip_sink.flush()
                         zip_buffer.seek(0)
-                        st.session_state.zip_buffer = zip_buffer
+                        # st.download_button does not accept a
+                        # SpooledTemporaryFile (and materializes the payload
+                        # at render anyway), so hand it the bytes and drop
+                        # the spool.
+                        zip_bytes = zip_buffer.read()
+                        zip_buffer.close()
                         st.success("✅ All invoices processed successfully!")
 
                         if failed_rows:
                             st.warning(f"{len(failed_rows)} invoices failed.")
-                            st.dataframe(pd.DataFrame(failed_rows))
+                            with st.expander("Failed invoices", expanded=True):
+                                st.dataframe(pd.DataFrame(failed_rows))
+
+                    st.markdown("---")
+                    st.subheader("💾 Download Ready")
+                    st.info("Click below to download all invoices as a ZIP file.")
+                    st.download_button(
+                        label="📦 Download ZIP",
+                        data=zip_bytes,
+                        file_name="coupa_invoice_scans.zip",
+                        mime="application/zip"
+                    )
 
     except Exception:
         st.warning("⚠️ Please upload a valid CSV file.")
         st.stop()
 
 
-# --- ZIP DOWNLOAD BUTTON ---
-if st.session_state.zip_buffer:
-    st.markdown("---")
-    st.subheader("💾 Download Ready")
-    st.info("Click below to download all invoices as a ZIP file.")
-
-    if st.download_button(
-        label="📦 Download ZIP",
-        data=st.session_state.zip_buffer,
-        file_name="coupa_invoice_scans.zip",
-        mime="application/zip"
-    ):
-        st.session_state.zip_buffer = None
-        st.success("✅ Download complete!")
-        st.rerun()
-
-
 # --- FOOTER ---
 st.markdown("---")
 st.caption("© 2025 Coupa Invoice Downloader | Created with by Farried Joemratie")